@@ -1,41 +1,37 @@
-from flask import Flask, jsonify, Response
+from flask import Flask, Response, request
+from flask_caching import Cache
 import requests
-import pandas as pd
 import numpy as np
-from datetime import datetime
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from datetime import datetime, timezone
 import time
 import concurrent.futures
-import json
+import fcntl
+import gzip
+import orjson
 import io
+import os
+import threading
+import zlib
 
 app = Flask(__name__)
 
-# Hàm helper để chuyển đổi numpy types sang Python types
-def convert_numpy_types(obj):
-    if isinstance(obj, np.integer):
-        return int(obj)
-    elif isinstance(obj, np.floating):
-        return float(obj)
-    elif isinstance(obj, np.ndarray):
-        return obj.tolist()
-    elif isinstance(obj, pd.DataFrame):
-        return obj.to_dict('records')
-    elif isinstance(obj, pd.Series):
-        return obj.to_dict()
-    return obj
-
-# Class JSONEncoder tùy chỉnh để xử lý các kiểu dữ liệu numpy
-class NumpyJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return super(NumpyJSONEncoder, self).default(obj)
-
-app.json_encoder = NumpyJSONEncoder
+# Cache toàn bộ response JSON đã tạo sẵn trong bộ nhớ
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache"})
+RESPONSE_CACHE_TIMEOUT = 300  # giây
+
+def _is_cacheable_response(response):
+    """Only successful responses are kept in the response cache."""
+    return response.status_code == 200
+
+def orjson_response(obj, status=200):
+    """Serializes obj with orjson and wraps it in a JSON Response."""
+    return Response(
+        orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NAIVE_UTC | orjson.OPT_OMIT_MICROSECONDS),
+        status=status,
+        mimetype="application/json"
+    )
 
 # Danh sách blockchain
 CHAINS = [
@@ -43,209 +39,358 @@ CHAINS = [
     "Aptos", "Arbitrum", "Sei", "Base", "BSC", 
     "Polygon", "Optimism", "Fantom", "Avalanche", "Celo"
 ]
+CHAIN_SET = frozenset(CHAINS)
+
+# Thread pool dùng chung, đủ worker để tải tất cả chain cùng lúc
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=len(CHAINS))
 
 # API URL template
 API_URL_TEMPLATE = "https://tvl-defillama-service-1094890588015.us-central1.run.app/tvl/{chain_id}"
 
+# API tuỳ chọn trả về TVL của nhiều chain trong một lần gọi, dạng {chain_id: [...]}
+# Ví dụ: TVL_BULK_API_URL_TEMPLATE=".../tvl?chains={chains}"
+BULK_API_URL_TEMPLATE = os.environ.get("TVL_BULK_API_URL_TEMPLATE")
+bulk_api_supported = bool(BULK_API_URL_TEMPLATE)
+bulk_fetch_lock = threading.Lock()
+# Chain mà bulk API không trả về; các chain này chỉ được tải riêng
+bulk_api_missing_chains = set()
+
+# Session dùng chung để giữ kết nối keep-alive tới API, tránh bắt tay TLS mỗi lần gọi
+SESSION = requests.Session()
+SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=20))
+
 # Cache dữ liệu để không phải gọi API mỗi lần
 tvl_cache = {}
 cache_time = {}
+fetch_locks = {chain: threading.Lock() for chain in CHAINS}
+
+# Cache kết quả đã xử lý, dùng lại cho đến khi dữ liệu gốc được tải lại
+processed_cache = {}
+
+# Cache file CSV đã nén gzip, dùng lại cho đến khi có chain được tải lại
+csv_cache = {}
+
+# Lưu cache xuống đĩa để khởi động lại không phải gọi lại API
+CACHE_FILE = os.environ.get("TVL_CACHE_FILE", "/tmp/tvl_cache.json.z")
+CACHE_FLUSH_INTERVAL = 60  # giây
+_cache_dirty = threading.Event()
+
+def read_cache_snapshot():
+    """Returns the snapshot stored in CACHE_FILE, or None if there is none."""
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            return orjson.loads(zlib.decompress(f.read()))
+    except FileNotFoundError:
+        return None
+
+def load_cache_from_disk():
+    """Populates the TVL cache from the snapshot on disk, if one exists."""
+    try:
+        snapshot = read_cache_snapshot()
+        if snapshot:
+            tvl_cache.update(snapshot["tvl_cache"])
+            cache_time.update(snapshot["cache_time"])
+    except Exception as e:
+        print(f"Error loading TVL cache from {CACHE_FILE}: {e}")
+
+def save_cache_to_disk():
+    """Merges the TVL cache into the snapshot on disk, keeping the newest entry per chain."""
+    try:
+        snapshot = {"tvl_cache": dict(tvl_cache), "cache_time": dict(cache_time)}
+        
+        # Khoá file để các worker gunicorn lần lượt đọc, gộp và ghi snapshot
+        with open(f"{CACHE_FILE}.lock", 'wb') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            
+            # Giữ lại các chain mà worker khác đã tải mới hơn
+            try:
+                on_disk = read_cache_snapshot()
+            except Exception as e:
+                print(f"Error reading TVL cache from {CACHE_FILE}, overwriting it: {e}")
+                on_disk = None
+            if on_disk:
+                for chain, fetched_at in on_disk["cache_time"].items():
+                    if chain in on_disk["tvl_cache"] and fetched_at > snapshot["cache_time"].get(chain, 0):
+                        snapshot["tvl_cache"][chain] = on_disk["tvl_cache"][chain]
+                        snapshot["cache_time"][chain] = fetched_at
+            
+            payload = zlib.compress(orjson.dumps(snapshot), 1)
+            
+            # Ghi ra file tạm rồi đổi tên để các worker khác không đọc phải file ghi dở
+            tmp_file = f"{CACHE_FILE}.{os.getpid()}.tmp"
+            with open(tmp_file, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_file, CACHE_FILE)
+    except Exception as e:
+        print(f"Error saving TVL cache to {CACHE_FILE}: {e}")
+
+def _flush_cache_periodically():
+    """Background loop that saves the cache at most once per CACHE_FLUSH_INTERVAL."""
+    while True:
+        _cache_dirty.wait()
+        time.sleep(CACHE_FLUSH_INTERVAL)
+        _cache_dirty.clear()
+        save_cache_to_disk()
+
+load_cache_from_disk()
+threading.Thread(target=_flush_cache_periodically, daemon=True).start()
+
+def get_cached_tvl_data(chain_id):
+    """Returns the cached TVL data for chain_id if it is less than an hour old, otherwise None."""
+    if chain_id in cache_time and time.time() - cache_time[chain_id] < 3600:  # Cache 1 giờ
+        return tvl_cache.get(chain_id)
+    return None
 
 def fetch_tvl_data(chain_id):
     """Fetches TVL data from the DeFi Llama API for a specific chain."""
     try:
         # Kiểm tra cache
-        current_time = time.time()
-        if chain_id in cache_time and current_time - cache_time[chain_id] < 3600:  # Cache 1 giờ
-            return tvl_cache.get(chain_id)
-            
-        api_url = API_URL_TEMPLATE.format(chain_id=chain_id)
-        response = requests.get(api_url)
-        response.raise_for_status()
+        data = get_cached_tvl_data(chain_id)
+        if data is not None:
+            return data
         
-        # Lưu vào cache
-        tvl_cache[chain_id] = response.json()
-        cache_time[chain_id] = current_time
+        # Chỉ một request được gọi API cho mỗi chain, các request khác chờ và dùng kết quả đó
+        lock = fetch_locks[chain_id]
+        if not lock.acquire(blocking=False):
+            with lock:
+                return tvl_cache.get(chain_id)
         
-        return response.json()
+        try:
+            # Request trước có thể vừa tải xong
+            data = get_cached_tvl_data(chain_id)
+            if data is not None:
+                return data
+            
+            current_time = time.time()
+            api_url = API_URL_TEMPLATE.format(chain_id=chain_id)
+            response = SESSION.get(api_url, timeout=10)
+            response.raise_for_status()
+            
+            # Lưu vào cache
+            tvl_cache[chain_id] = response.json()
+            cache_time[chain_id] = current_time
+            _cache_dirty.set()
+            
+            return tvl_cache[chain_id]
+        finally:
+            lock.release()
     except Exception as e:
         print(f"Error fetching TVL data for {chain_id}: {e}")
         return None
 
+def fetch_all_tvl_bulk():
+    """Refreshes every stale chain with a single call to the bulk API, if one is configured."""
+    global bulk_api_supported
+    if not bulk_api_supported:
+        return
+        
+    try:
+        # Chỉ một request gọi bulk API, các request khác chờ rồi kiểm tra lại cache
+        with bulk_fetch_lock:
+            stale_chains = [
+                chain for chain in CHAINS
+                if chain not in bulk_api_missing_chains and get_cached_tvl_data(chain) is None
+            ]
+            if not stale_chains:
+                return
+                
+            current_time = time.time()
+            api_url = BULK_API_URL_TEMPLATE.format(chains=",".join(stale_chains))
+            response = SESSION.get(api_url, timeout=10)
+            if response.status_code == 404:
+                # API không hỗ trợ, từ giờ chỉ tải từng chain
+                bulk_api_supported = False
+                return
+            response.raise_for_status()
+            
+            # Lưu vào cache; chain thiếu trong kết quả sẽ được tải riêng từ giờ
+            results = response.json()
+            for chain in stale_chains:
+                if results.get(chain):
+                    tvl_cache[chain] = results[chain]
+                    cache_time[chain] = current_time
+                else:
+                    bulk_api_missing_chains.add(chain)
+            _cache_dirty.set()
+    except Exception as e:
+        print(f"Error fetching bulk TVL data: {e}")
+
 def process_tvl_data(data, chain_id):
-    """Processes the TVL API data and returns a pandas DataFrame."""
+    """Processes the TVL API data into numpy date/tvl columns sorted by date, newest first."""
     try:
         if not data:
             return None
             
-        # Convert JSON to DataFrame
-        df = pd.DataFrame(data)
-        
-        # Convert Unix timestamp to datetime
-        df['date_time'] = pd.to_datetime(df['date'], unit='s')
-        df['date'] = df['date_time'].dt.strftime('%Y-%m-%d')
+        # Sắp xếp theo Unix timestamp, mới nhất trước
+        timestamps = np.fromiter((item['date'] for item in data), dtype=np.int64, count=len(data))
+        order = np.argsort(timestamps)[::-1]
         
-        # Add chain column
-        df['chain'] = chain_id
+        # Convert Unix timestamp to fixed-width YYYY-MM-DD strings
+        dates = timestamps[order].astype('datetime64[s]').astype('datetime64[D]').astype('<U10')
         
-        # Convert numeric columns to float
-        df['tvl'] = pd.to_numeric(df['tvl'], errors='coerce')
+        # Convert tvl to float, missing values become NaN
+        tvl = np.array([item['tvl'] for item in data], dtype=np.float64)[order]
         
-        return df
+        return {"chain": chain_id, "dates": dates, "tvl": tvl}
     except Exception as e:
         print(f"Error processing TVL data for {chain_id}: {e}")
         return None
 
-@app.route('/api/tvl/<chain_id>', methods=['GET'])
-def get_tvl_for_chain(chain_id):
-    """API endpoint to get TVL data for a specific chain."""
-    if chain_id not in CHAINS:
-        return jsonify({"error": f"Invalid chain ID. Supported chains: {', '.join(CHAINS)}"}), 400
-        
-    data = fetch_tvl_data(chain_id)
-    if not data:
-        return jsonify({"error": f"Failed to fetch data for {chain_id}"}), 500
-        
-    df = process_tvl_data(data, chain_id)
-    if df is None or df.empty:
-        return jsonify({"error": f"Failed to process data for {chain_id}"}), 500
-    
-    # Lấy dữ liệu mới nhất
-    latest = df.sort_values('date', ascending=False).iloc[0]
+def summarize_tvl_data(processed):
+    """Builds the latest TVL, 24h change and 30-day history from process_tvl_data output."""
+    dates = processed['dates']
+    tvl = processed['tvl']
     
     # Tính phần trăm thay đổi 24h
-    if len(df) > 1:
-        yesterday = df.sort_values('date', ascending=False).iloc[1]
-        change = latest['tvl'] - yesterday['tvl']
-        percent_change = (change / yesterday['tvl']) * 100 if yesterday['tvl'] > 0 else 0
+    if len(tvl) > 1:
+        change = tvl[0] - tvl[1]
+        percent_change = (change / tvl[1]) * 100 if tvl[1] > 0 else 0
     else:
         change = 0
         percent_change = 0
     
-    # Chuyển đổi giá trị numpy sang Python types
-    history_data = df[['date', 'tvl']].sort_values('date', ascending=False).head(30).to_dict('records')
-    history_data = [
-        {"date": item["date"], "tvl": float(item["tvl"])} 
-        for item in history_data
-    ]
+    # tolist() chuyển cả mảng sang kiểu Python một lần thay vì tạo numpy scalar cho từng phần tử
+    history_data = [{"date": date, "tvl": value} for date, value in zip(dates[:30].tolist(), tvl[:30].tolist())]
     
-    result = {
-        "chain": chain_id,
-        "latest_date": str(latest['date']),
-        "tvl": float(latest['tvl']),
+    return {
+        "chain": processed['chain'],
+        "latest_date": str(dates[0]),
+        "tvl": float(tvl[0]),
         "tvl_change_24h": float(change),
         "tvl_percent_change_24h": float(percent_change),
         "history": history_data
     }
+
+def get_processed_tvl_data(chain_id):
+    """Fetches chain_id and returns its processed columns and summary, reusing them until the raw data is refetched."""
+    try:
+        data = fetch_tvl_data(chain_id)
+        if not data:
+            return None, None
+            
+        cached = processed_cache.get(chain_id)
+        if cached is not None and cached[0] is data:
+            return cached[1], cached[2]
+            
+        processed = process_tvl_data(data, chain_id)
+        if processed is None:
+            return None, None
+            
+        summary = summarize_tvl_data(processed)
+        processed_cache[chain_id] = (data, processed, summary)
+        return processed, summary
+    except Exception as e:
+        print(f"Error processing {chain_id}: {e}")
+        return None, None
+
+def _build_chain_payload(chain_id):
+    """Returns the summary payload served for chain_id, or None if it could not be loaded."""
+    return get_processed_tvl_data(chain_id)[1]
+
+@app.route('/api/tvl/<chain_id>', methods=['GET'])
+@cache.cached(timeout=RESPONSE_CACHE_TIMEOUT, response_filter=_is_cacheable_response)
+def get_tvl_for_chain(chain_id):
+    """API endpoint to get TVL data for a specific chain."""
+    if chain_id not in CHAIN_SET:
+        return orjson_response({"error": f"Invalid chain ID. Supported chains: {', '.join(CHAINS)}"}, status=400)
+        
+    payload = _build_chain_payload(chain_id)
+    if payload is None:
+        return orjson_response({"error": f"Failed to load data for {chain_id}"}, status=500)
     
-    return jsonify(result)
+    return orjson_response(payload)
 
 @app.route('/api/tvl/all', methods=['GET'])
+@cache.cached(timeout=RESPONSE_CACHE_TIMEOUT, response_filter=_is_cacheable_response)
 def get_all_tvl():
     """API endpoint to get latest TVL data for all chains."""
-    results = []
-    total_tvl = 0
+    fetch_all_tvl_bulk()
     
     # Fetch data for all chains in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_chain = {executor.submit(fetch_tvl_data, chain): chain for chain in CHAINS}
-        
-        for future in concurrent.futures.as_completed(future_to_chain):
-            chain = future_to_chain[future]
-            try:
-                data = future.result()
-                if data:
-                    df = process_tvl_data(data, chain)
-                    if df is not None and not df.empty:
-                        latest = df.sort_values('date', ascending=False).iloc[0]
-                        
-                        # Tính phần trăm thay đổi 24h
-                        if len(df) > 1:
-                            yesterday = df.sort_values('date', ascending=False).iloc[1]
-                            change = latest['tvl'] - yesterday['tvl']
-                            percent_change = (change / yesterday['tvl']) * 100 if yesterday['tvl'] > 0 else 0
-                        else:
-                            change = 0
-                            percent_change = 0
-                        
-                        # Chuyển đổi history data
-                        history_data = df[['date', 'tvl']].sort_values('date', ascending=False).head(30).to_dict('records')
-                        history_data = [
-                            {"date": item["date"], "tvl": float(item["tvl"])} 
-                            for item in history_data
-                        ]
-                        
-                        # Chuyển đổi numpy values sang Python types
-                        chain_result = {
-                            "chain": chain,
-                            "latest_date": str(latest['date']),
-                            "tvl": float(latest['tvl']),
-                            "tvl_change_24h": float(change),
-                            "tvl_percent_change_24h": float(percent_change),
-                            "history": history_data
-                        }
-                        
-                        results.append(chain_result)
-                        total_tvl += float(latest['tvl'])
-            except Exception as e:
-                print(f"Error processing {chain}: {e}")
+    results = [payload for payload in EXECUTOR.map(_build_chain_payload, CHAINS) if payload is not None]
+    total_tvl = sum(payload['tvl'] for payload in results)
     
     # Sắp xếp kết quả theo TVL giảm dần
     results.sort(key=lambda x: x['tvl'], reverse=True)
     
-    return jsonify({
-        "timestamp": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    return orjson_response({
+        "timestamp": datetime.now(timezone.utc),
         "total_tvl": float(total_tvl),
         "chains": results
     })
 
+def format_tvl_values(tvl):
+    """Formats tvl floats the way the CSV export always has: repr() digits, NaN as an empty field."""
+    # pyarrow tự định dạng số thực khác (1234567.0 -> 1234567, 1e-05 -> 0.00001), nên định dạng trước
+    return [None if value != value else repr(value) for value in tvl.tolist()]
+
+def build_tvl_csv(chains_data):
+    """Renders processed chain data as CSV bytes ordered by chain, then date."""
+    # Sắp xếp theo chain, rồi theo date tăng dần (dữ liệu đã xử lý đang mới nhất trước)
+    tables = [
+        pa.table({
+            "chain": pa.array([processed['chain']] * len(processed['tvl'])),
+            "date": processed['dates'][::-1],
+            "tvl": pa.array(format_tvl_values(processed['tvl'][::-1]))
+        })
+        for processed in sorted(chains_data, key=lambda x: x['chain'])
+    ]
+    combined = pa.concat_tables(tables)
+    
+    # Tạo CSV trong bộ nhớ; chain và date không chứa dấu phẩy nên không cần quote
+    csv_buffer = io.BytesIO()
+    csv_buffer.write(b"chain,date,tvl\n")
+    pa_csv.write_csv(combined, csv_buffer, pa_csv.WriteOptions(include_header=False, quoting_style="none"))
+    return csv_buffer.getvalue()
+
+def iter_gunzip(payload, chunk_size=64 * 1024):
+    """Yields the decompressed contents of a gzip payload chunk by chunk."""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for start in range(0, len(payload), chunk_size):
+        yield decompressor.decompress(payload[start:start + chunk_size])
+    yield decompressor.flush()
+
 @app.route('/api/tvl/csv', methods=['GET'])
 def get_tvl_csv():
     """API endpoint to get TVL data for all chains in CSV format."""
-    all_data = []
+    chains_data = []
+    fetch_all_tvl_bulk()
     
     # Fetch data for all chains in parallel
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_chain = {executor.submit(fetch_tvl_data, chain): chain for chain in CHAINS}
-        
-        for future in concurrent.futures.as_completed(future_to_chain):
-            chain = future_to_chain[future]
-            try:
-                data = future.result()
-                if data:
-                    df = process_tvl_data(data, chain)
-                    if df is not None and not df.empty:
-                        # Chỉ lấy các cột cần thiết: chain, date và tvl
-                        chain_df = df[['chain', 'date', 'tvl']].copy()
-                        all_data.append(chain_df)
-            except Exception as e:
-                print(f"Error processing {chain} for CSV: {e}")
-    
-    if not all_data:
-        return jsonify({"error": "No data available to export"}), 500
+    for processed, summary in EXECUTOR.map(get_processed_tvl_data, CHAINS):
+        if processed is not None:
+            chains_data.append(processed)
     
-    # Kết hợp tất cả dữ liệu
-    combined_df = pd.concat(all_data)
+    if not chains_data:
+        return orjson_response({"error": "No data available to export"}, status=500)
     
-    # Sắp xếp dữ liệu theo chain và date
-    combined_df = combined_df.sort_values(['chain', 'date'])
-    
-    # Tạo CSV trong bộ nhớ
-    csv_buffer = io.StringIO()
-    combined_df.to_csv(csv_buffer, index=False)
+    # Chỉ tạo lại file CSV khi có chain được tải lại
+    cache_key = tuple((processed['chain'], cache_time.get(processed['chain'])) for processed in chains_data)
+    cached = csv_cache.get("tvl_data")
+    if cached is not None and cached[0] == cache_key:
+        payload = cached[1]
+    else:
+        payload = gzip.compress(build_tvl_csv(chains_data), compresslevel=1)
+        csv_cache["tvl_data"] = (cache_key, payload)
     
     # Tạo response với CSV
+    headers = {"Content-Disposition": "attachment;filename=tvl_data.csv", "Vary": "Accept-Encoding"}
+    if request.accept_encodings["gzip"] > 0:
+        headers["Content-Encoding"] = "gzip"
+    else:
+        # Giải nén dần khi gửi thay vì tạo thêm một bản CSV đầy đủ trong bộ nhớ
+        payload = iter_gunzip(payload)
+    
     response = Response(
-        csv_buffer.getvalue(),
+        payload,
         mimetype="text/csv",
-        headers={"Content-Disposition": "attachment;filename=tvl_data.csv"}
+        headers=headers
     )
     
     return response
 
-@app.route('/', methods=['GET'])
-def home():
-    return """
+# Trang chủ không đổi theo request nên chỉ tạo HTML một lần
+HOME_HTML = """
     <html>
         <head>
             <title>TVL API</title>
@@ -286,5 +431,9 @@ def home():
     </html>
     """
 
+@app.route('/', methods=['GET'])
+def home():
+    return HOME_HTML
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file